@@ -0,0 +1,131 @@
+import os, sys, json, time, signal, shutil, subprocess, tempfile, urllib.request
+
+# =========================
+# Chromium persistente compartido entre corridas del cron
+# =========================
+# monitor.py se conecta vía CDP (connect_over_cdp) al endpoint guardado en WS_FILE
+# en vez de pagar el arranque en frío de Chromium en cada tick.
+WS_FILE = os.getenv("BROWSER_WS_FILE", "/tmp/cs-ws")
+PID_FILE = WS_FILE + ".pid"
+COUNT_FILE = WS_FILE + ".count"   # contexts abiertos desde el último (re)arranque
+PROFILE_FILE = WS_FILE + ".profile"   # user-data-dir temporal; stop() lo borra
+CDP_PORT = int(os.getenv("BROWSER_CDP_PORT", "9222"))
+START_TIMEOUT = 20
+
+# Flags para scraping headless: sin GPU, extensiones ni servicios de fondo => menos RAM y arranque más rápido.
+# Compartidos con el launch local de monitor.py.
+CHROMIUM_ARGS = [
+    "--disable-gpu",
+    "--disable-dev-shm-usage",
+    "--no-sandbox",
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-sync",
+    "--disable-translate",
+    "--disable-features=AutomationControlled,MediaRouter,OptimizationHints,Translate,BackForwardCache",
+    "--no-first-run",
+    "--mute-audio",
+    "--renderer-process-limit=2",
+]
+
+def read_endpoint():
+    try:
+        with open(WS_FILE) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def _write(path, text):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def _wait_ws_endpoint():
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{CDP_PORT}/json/version", timeout=2) as resp:
+                return json.load(resp)["webSocketDebuggerUrl"]
+        except Exception:
+            time.sleep(0.25)
+    return None
+
+def start():
+    from playwright.sync_api import sync_playwright
+    with sync_playwright() as p:
+        exe = p.chromium.executable_path
+    profile = tempfile.mkdtemp(prefix="cs-chromium-")
+    _write(PROFILE_FILE, profile)
+    proc = subprocess.Popen(
+        [
+            exe,
+            "--headless=new",
+            f"--remote-debugging-port={CDP_PORT}",
+            f"--user-data-dir={profile}",
+            *CHROMIUM_ARGS,
+            "about:blank",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    ws = _wait_ws_endpoint()
+    if not ws:
+        proc.kill()
+        proc.wait()
+        shutil.rmtree(profile, ignore_errors=True)
+        os.remove(PROFILE_FILE)
+        raise RuntimeError("Chromium no expuso el endpoint CDP a tiempo.")
+    _write(PID_FILE, str(proc.pid))
+    _write(COUNT_FILE, "0")
+    _write(WS_FILE, ws)
+    return ws
+
+def _wait_exit(pid, timeout=5):
+    # El profile solo se puede borrar cuando Chromium soltó sus archivos
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return
+        time.sleep(0.1)
+
+def stop():
+    try:
+        with open(PID_FILE) as f:
+            pid = int(f.read().strip())
+        os.kill(pid, signal.SIGTERM)
+        _wait_exit(pid)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(PROFILE_FILE) as f:
+            shutil.rmtree(f.read().strip(), ignore_errors=True)
+    except OSError:
+        pass
+    for path in (WS_FILE, PID_FILE, COUNT_FILE, PROFILE_FILE):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def bump_count(n):
+    try:
+        with open(COUNT_FILE) as f:
+            count = int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        count = 0
+    count += n
+    _write(COUNT_FILE, str(count))
+    return count
+
+if __name__ == "__main__":
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "start"
+    if cmd == "stop":
+        stop()
+    elif cmd == "restart":
+        stop(); print(start())
+    else:
+        print(start())
@@ -1,5 +1,33 @@
-import os, json, hashlib, time, random, urllib.request, urllib.parse, sys, traceback, re
-from playwright.sync_api import sync_playwright
+import os, json, hashlib, gzip, time, random, urllib.request, urllib.parse, urllib.error, sys, traceback, re, asyncio, subprocess, functools
+from collections import defaultdict
+from operator import itemgetter
+from pathlib import Path
+import browser_daemon
+
+# Fingerprint del estado: BLAKE3 (SIMD) si está instalado, si no BLAKE2b de hashlib.
+# Ambos truncados a 16 bytes; solo se usa para detectar cambios.
+try:
+    from blake3 import blake3 as _blake3
+    def _new_hasher(): return _blake3()
+    def _hexdigest(h): return h.hexdigest(16)
+except ImportError:
+    def _new_hasher(): return hashlib.blake2b(digest_size=16)
+    def _hexdigest(h): return h.hexdigest()
+
+# (De)serialización del estado: orjson (bytes directo, ~3x) si está instalado, si no json de stdlib
+try:
+    import orjson
+    def _loads(b): return orjson.loads(b)
+    def _dumps(o): return orjson.dumps(o, option=orjson.OPT_SORT_KEYS)
+except ImportError:
+    def _loads(b): return json.loads(b)
+    def _dumps(o): return json.dumps(o, separators=(",", ":"), sort_keys=True).encode()
+
+# Estado como baseline + JSON-Patches (los ticks casi no cambian filas). Sin jsonpatch: snapshot completo.
+try:
+    import jsonpatch
+except ImportError:
+    jsonpatch = None
 
 # =========================
 # Utilidades
@@ -14,40 +42,258 @@ def load_json_env(key: str, default_val):
         print(f"WARN: invalid {key}; using defaults. Error:", e)
         return default_val
 
+# Mensajes del tick: se encolan con notify() y salen juntos en flush_notify()
+_queue = []
+TG_MAX_LEN = 4096     # límite de Telegram por mensaje
+TG_MAX_TRIES = 2      # un solo reintento (tras retry_after si es 429)
+TG_CHUNK_SPACING = 0.034   # Telegram: ~30 msg/s por chat
+
 def notify(text: str):
+    _queue.append(text)
+
+def _split_message(text, limit=TG_MAX_LEN):
+    # Cortamos en los separadores de grupo ("\n— ") para que cada mensaje sea coherente
+    parts, cur = [], ""
+    for seg in text.split("\n— "):
+        if cur:
+            seg = "\n— " + seg
+        if cur and len(cur) + len(seg) > limit:
+            parts.append(cur)
+            cur = seg.lstrip("\n")
+        else:
+            cur += seg
+    parts.append(cur)
+    return [chunk for p in parts for chunk in _split_lines(p, limit)]
+
+def _split_lines(text, limit):
+    # Un grupo que solo ya excede el límite se corta por líneas (y una línea gigante, a lo bruto)
+    if len(text) <= limit:
+        return [text]
+    chunks, cur = [], ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if cur:
+                chunks.append(cur); cur = ""
+            chunks.append(line[:limit]); line = line[limit:]
+        if cur and len(cur) + 1 + len(line) > limit:
+            chunks.append(cur); cur = line
+        else:
+            cur = f"{cur}\n{line}" if cur else line
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+def _tg_send(token, chat, text):
+    data = urllib.parse.urlencode({"chat_id": chat, "text": text, "disable_web_page_preview": "true"}).encode()
+    for attempt in range(TG_MAX_TRIES):
+        try:
+            urllib.request.urlopen(f"https://api.telegram.org/bot{token}/sendMessage", data=data, timeout=10)
+            return True
+        except urllib.error.HTTPError as e:
+            if e.code != 429 or attempt == TG_MAX_TRIES - 1:
+                print("WARN: Telegram send failed ->", e)
+                return False
+            try:
+                wait = int(json.load(e).get("parameters", {}).get("retry_after", 0))
+            except Exception:
+                wait = 0
+            time.sleep(wait or 2 ** attempt)
+        except Exception as e:
+            if attempt == TG_MAX_TRIES - 1:
+                print("WARN: Telegram send failed ->", e)
+                return False
+            time.sleep(2 ** attempt)
+    return False
+
+def flush_notify():
+    if not _queue:
+        return
+    text = "\n\n".join(_queue)
+    _queue.clear()
     TG_TOKEN = os.getenv("TELEGRAM_TOKEN", "")
     TG_CHAT  = os.getenv("TELEGRAM_CHAT_ID", "")
     if TG_TOKEN and TG_CHAT:
-        try:
-            data = urllib.parse.urlencode({"chat_id": TG_CHAT, "text": text}).encode()
-            urllib.request.urlopen(f"https://api.telegram.org/bot{TG_TOKEN}/sendMessage", data=data, timeout=10)
+        sent = True
+        for i, part in enumerate(_split_message(text)):
+            if i:
+                time.sleep(TG_CHUNK_SPACING)
+            sent = _tg_send(TG_TOKEN, TG_CHAT, part) and sent
+        if sent:
             return
-        except Exception as e:
-            print("WARN: Telegram send failed ->", e)
     print("NOTIFY:", text)
 
+def load_state(path, default_val):
+    try:
+        return _loads(Path(path).read_bytes())
+    except Exception:
+        return default_val
+
+def state_rows(state):
+    # Reconstruye las filas: snapshot viejo ("rows") o baseline + patches aplicados en orden
+    if "baseline" not in state:
+        return state.get("rows", [])
+    rows = state["baseline"]
+    if state.get("patches"):
+        if jsonpatch is None:
+            print("WARN: state.json tiene patches pero jsonpatch no está instalado; ignorando estado previo")
+            return []
+        for p in state["patches"]:
+            rows = jsonpatch.apply_patch(rows, p["ops"])
+    return rows
+
+def pack_state(new_state, old_state):
+    # Dict a persistir: append del patch contra el tick anterior; re-baseline cuando los
+    # patches acumulados pesan más de 2x el baseline
+    out = {k: v for k, v in new_state.items() if k != "rows"}
+    rows = new_state["rows"]
+    if jsonpatch is None:
+        out["rows"] = rows
+        return out
+    if "baseline" in old_state:
+        ops = jsonpatch.make_patch(old_state["rows"], rows).patch
+        patches = list(old_state.get("patches") or [])
+        if ops:
+            patches.append({"ts": new_state["ts"], "ops": ops})
+        if len(_dumps(patches)) <= 2 * len(_dumps(old_state["baseline"])):
+            out["baseline"], out["patches"] = old_state["baseline"], patches
+            return out
+    out["baseline"], out["patches"] = rows, []
+    return out
+
+def save_state(obj, path):
+    # tmp + os.replace: un crash a mitad de escritura nunca deja el estado corrupto.
+    # hash_rows no serializa JSON, así que el estado se serializa una sola vez por tick.
+    tmp = path + ".tmp"
+    Path(tmp).write_bytes(_dumps(obj))
+    os.replace(tmp, path)
+
+# Derivados que solo viven en memoria durante el tick (no se persisten en rows);
+# content_hash queda de estados viejos que hasheaban la fila completa
+_TRANSIENT_KEYS = ("_sig", "content_hash")
+
+# Firma compacta de lo que importa para detectar cambios en una clase
+def row_sig(r):
+    return (r.get("open_now"), r.get("start"), r.get("location"), r.get("instructor"))
+
+def fingerprint(data: bytes):
+    h = _new_hasher()
+    h.update(data)
+    return _hexdigest(h)
+
 def hash_rows(rows):
-    return hashlib.sha256(json.dumps(rows, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+    # Solo lo que define un cambio (class_id + firma), no la fila completa: entrada chica y barata
+    h = _new_hasher()
+    lines = sorted(
+        "|".join((r.get("class_id") or "", *map(str, r.get("_sig") or row_sig(r)))) + "\n"
+        for r in rows
+    )
+    for line in lines:
+        h.update(line.encode())
+    return _hexdigest(h)
+
+# numpy se importa recién al necesitarlo (como Playwright en _pw()): los ticks rápidos no lo pagan
+@functools.lru_cache(maxsize=1)
+def _np():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+def _diff_sigs_np(np, old, new):
+    # class_id numéricos -> int64; firma -> hash() (mismo proceso para ambos lados).
+    # Solo IDs en forma canónica (str(int(k)) == k): así int() es inyectivo ("01234" y "1234"
+    # no colapsan). Si no, None => diff con dicts.
+    old_keys, new_keys = list(old), list(new)
+    try:
+        old_ints, new_ints = [int(k) for k in old_keys], [int(k) for k in new_keys]
+        old_ids = np.array(old_ints, dtype=np.int64)
+        new_ids = np.array(new_ints, dtype=np.int64)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    if any(str(i) != k for i, k in zip(old_ints, old_keys)) or any(str(i) != k for i, k in zip(new_ints, new_keys)):
+        return None
+    old_h = np.fromiter(map(hash, old.values()), dtype=np.int64, count=len(old_keys))
+    new_h = np.fromiter(map(hash, new.values()), dtype=np.int64, count=len(new_keys))
+
+    _, oi, ni = np.intersect1d(old_ids, new_ids, assume_unique=True, return_indices=True)
+    added = [new_keys[i] for i in np.flatnonzero(~np.isin(new_ids, old_ids, assume_unique=True))]
+    removed = [old_keys[i] for i in np.flatnonzero(~np.isin(old_ids, new_ids, assume_unique=True))]
+    changed = []
+    for i in np.flatnonzero(old_h[oi] != new_h[ni]):
+        k = new_keys[ni[i]]
+        if old[k] != new[k]:   # descarta colisiones de hash
+            changed.append((k, old[k], new[k]))
+    return added, removed, changed
+
+def diff_sigs(old, new):
+    # {class_id: firma} viejo vs nuevo -> (added, removed, [(id, firma_vieja, firma_nueva)])
+    if max(len(old), len(new)) >= NUMPY_DIFF_MIN_ROWS:
+        # Diff vectorizado para miles de filas (QUERIES de un departamento entero); numpy opcional
+        np = _np()
+        res = _diff_sigs_np(np, old, new) if np is not None else None
+        if res is not None:
+            return res
+    # Una sola pasada sobre la unión de IDs; la comparación es una igualdad de tuplas
+    added, removed, changed = [], [], []
+    for k in old.keys() | new.keys():
+        old_sig, new_sig = old.get(k), new.get(k)
+        if old_sig is None:
+            added.append(k)
+        elif new_sig is None:
+            removed.append(k)
+        elif old_sig != new_sig:
+            changed.append((k, old_sig, new_sig))
+    return added, removed, changed
 
 # =========================
 # Config
 # =========================
 URL = os.getenv("URL", "https://catalog.apps.asu.edu/catalog/classes")
+# Fragmento de URL del XHR de búsqueda que dispara la SPA (JSON con las clases)
+API_URL_MATCH = os.getenv("API_URL_MATCH", "/search/classes")
+# Headers extra para pedir el XHR fuera del browser (p.ej. auth, vía secrets); nunca se persisten
+API_HEADERS = load_json_env("API_HEADERS_JSON", {})
+
+# Probe condicional (ETag/Last-Modified del XHR) antes de lanzar Chromium. 1=habilitado / 0=siempre scrapear.
+CONDITIONAL_PROBE = int(os.getenv("CONDITIONAL_PROBE", "1"))
+# Si el XHR cambió, parsear su JSON directo (1) o volver a Playwright (0)
+DIRECT_API = int(os.getenv("DIRECT_API", "1"))
+# URL del XHR para el primer tick (antes de haberlo capturado con Playwright).
+# Campos: {subject} {number} {term} {term_code}; vacío => el primer tick usa Chromium
+API_URL_TEMPLATE = os.getenv("API_URL_TEMPLATE", "").strip()
+# Solo estos headers del request original se guardan en state.json (se commitea: nada de cookies)
+PROBE_HEADER_ALLOW = frozenset({"accept", "accept-language", "content-type", "origin", "referer", "x-requested-with"})
 QUERIES = load_json_env("QUERIES_JSON", [
     {"subject":"CSE","number":"412","term":"Spring 2026"}
 ])
 
 # Solo excluir “ASU Online” (iCourse SÍ entra)
 LOCATION_EXCLUDE_REGEX = os.getenv("LOCATION_EXCLUDE_REGEX", r"(?i)\bASU\s*Online\b")
+try:
+    _LOCATION_EXCLUDE_RE = re.compile(LOCATION_EXCLUDE_REGEX, re.I)
+except re.error as e:
+    print("WARN: invalid LOCATION_EXCLUDE_REGEX; not excluding any location. Error:", e)
+    _LOCATION_EXCLUDE_RE = None
 
-STATE = "state.json"
-NOTIFY_STATE = "notify_state.json"   # persistimos último ping “no cambios”
+STATE = "state.json"                 # rows + hash + último ping “no cambios”
+SELECTORS_FILE = "selectors.json"    # estrategia de localización ganadora por campo
+TERM_CODES_FILE = "term_codes.json"  # label del term -> código ("Spring 2026" -> "2261")
+TERM_CODES_MAX_AGE = 30 * 86400      # se rearma una vez al mes (terms nuevos)
+LEGACY_NOTIFY_STATE = "notify_state.json"   # antes el ping vivía aparte; solo se lee para migrar
 DEBUG_DIR = "debug"
+DEBUG = int(os.getenv("DEBUG", "0"))
 VIDEO_DIR = "recordings"
 
 # Jitter anti-patrón exacto (puedes definir JITTER_MIN_SEC/JITTER_MAX_SEC en el workflow)
 JITTER_MIN = int(os.getenv("JITTER_MIN_SEC", "0"))
 JITTER_MAX = int(os.getenv("JITTER_MAX_SEC", "0"))
+# 1=habilitado / 0=sin jitter. En CI los sleeps (inicial y desfase por query) son minutos facturados: solo con JITTER_IN_CI=1.
+JITTER = int(os.getenv("JITTER", "1"))
+JITTER_IN_CI = int(os.getenv("JITTER_IN_CI", "0"))
+JITTER_ON = bool(JITTER) and (bool(JITTER_IN_CI) or not os.getenv("CI"))
+# Desfase por query en paralelo (0..N s), derivado del hash de la query: se reparten solas sin un sleep común
+QUERY_STAGGER_MAX = float(os.getenv("QUERY_STAGGER_MAX_SEC", "2"))
 
 # Ping “no change” cada X segundos (default 1h). 1=habilitado / 0=deshabilitado.
 NOCHANGE_NOTIFY_INTERVAL = int(os.getenv("NOCHANGE_NOTIFY_INTERVAL_SEC", "3600"))
@@ -59,11 +305,23 @@ TRIGGER_ZERO_TO_POSITIVE = int(os.getenv("TRIGGER_ZERO_TO_POSITIVE", "1"))
 # Notificar si caen >= este umbral de golpe
 TRIGGER_DROP_THRESHOLD = int(os.getenv("TRIGGER_DROP_THRESHOLD", "5"))
 
+# Desde cuántas filas el diff pasa a numpy (si está instalado); por debajo los dicts ganan
+NUMPY_DIFF_MIN_ROWS = int(os.getenv("NUMPY_DIFF_MIN_ROWS", "2000"))
+
 # =========================
 # Helpers de localización
 # =========================
-def first_locator(page, kind, value, timeout=9000, name_regex=False):
-    import re as _re
+# Playwright se importa recién al usarlo (~200 ms): los ticks resueltos vía XHR directo no lo pagan
+@functools.lru_cache(maxsize=1)
+def _pw():
+    import playwright.async_api
+    return playwright.async_api
+
+@functools.lru_cache(maxsize=64)
+def _re(s):
+    return re.compile(s, re.I)
+
+async def first_locator(page, kind, value, timeout=9000, name_regex=False):
     try:
         if kind == "label":
             loc = page.get_by_label(value, exact=False)
@@ -75,18 +333,20 @@ def first_locator(page, kind, value, timeout=9000, name_regex=False):
             loc = page.get_by_text(value, exact=False)
         elif kind == "role":
             role, name = value
-            loc = page.get_by_role(role, name=_re.compile(name, _re.I)) if name_regex else page.get_by_role(role, name=name)
+            loc = page.get_by_role(role, name=_re(name)) if name_regex else page.get_by_role(role, name=name)
         else:
             return None
-        loc.first.wait_for(state="visible", timeout=timeout)
+        await loc.first.wait_for(state="visible", timeout=timeout)
         return loc.first
     except Exception:
         return None
 
-def wait_hydrated(page, target_term_text: str):
-    first_locator(page, "role", ("button", "Search Classes")).wait_for(state="visible", timeout=20000)
+async def wait_hydrated(page, target_term_text: str):
+    btn = await first_locator(page, "role", ("button", "Search Classes"), timeout=20000)
+    if not btn:
+        raise RuntimeError("La página no hidrató (sin botón 'Search Classes').")
     try:
-        page.wait_for_function(
+        await page.wait_for_function(
             """(term) => {
                 const txt = document.body.innerText || '';
                 return (!txt.includes('Previous Terms')) || txt.includes(term);
@@ -96,102 +356,202 @@ def wait_hydrated(page, target_term_text: str):
         )
     except Exception:
         pass
-    page.wait_for_timeout(500)
-
-def get_subject_input(page):
-    for k, v in [
-        ("placeholder", "Subject"),
-        ("label", "Subject"),
-        ("css", 'input[aria-label*="Subject" i]'),
-        ("css", '#subject'),
-        ("css", 'input[name="subject"]'),
-        ("css", 'input[id*="subject" i]'),
-    ]:
-        loc = first_locator(page, k, v)
-        if loc: return loc
+    # Sin sleep fijo de "asentamiento": fill/select_option/click ya esperan a que el control sea accionable
+
+# Candidatos CSS por campo, en orden de preferencia. Se prueban todos en una sola
+# llamada JS (probe_locator) en vez de un first_locator + espera por candidato.
+SUBJECT_CANDS = (
+    'input[placeholder*="Subject" i]',
+    'input[aria-label*="Subject" i]',
+    '#subject',
+    'input[name="subject"]',
+    'input[id*="subject" i]',
+)
+NUMBER_CANDS = (
+    'input[placeholder*="Number" i]',
+    'input[aria-label*="Number" i]',
+    '#number',
+    'input[name="number"]',
+    'input[name="catalogNbr"]',
+    '#catalogNbr',
+    'input[id*="number" i]',
+    'input[id*="catalog" i]',
+)
+TERM_CANDS = (
+    'select[name="term"]',
+    '#term',
+    'select[aria-label*="Term" i]',
+)
+SEARCH_CANDS = ('button', '[role="button"]')
+SEARCH_TEXT = r"Search\s*Classes"
+_re(SEARCH_TEXT)   # precompilado al importar
+
+_PROBE_JS = """([sels, textRe]) => {
+    const re = textRe ? new RegExp(textRe, 'i') : null;
+    for (const s of sels) {
+        for (const el of document.querySelectorAll(s)) {
+            if (el.offsetParent === null) continue;
+            if (re && !re.test(el.innerText || el.value || '')) continue;
+            return s;
+        }
+    }
+    return null;
+}"""
+
+async def probe_locator(page, sels, text_re=None, timeout=9000):
+    # Espera (en el browser) a que algún candidato sea visible y devuelve su locator
+    try:
+        handle = await page.wait_for_function(_PROBE_JS, arg=[list(sels), text_re], timeout=timeout)
+        sel = await handle.json_value()
+    except _pw().TimeoutError:
+        return None
+    loc = page.locator(f"{sel} >> visible=true")
+    if text_re:
+        loc = loc.filter(has_text=_re(text_re))
+    return loc.first
+
+# =========================
+# Caché de estrategias ganadoras por campo (persistida en SELECTORS_FILE)
+# =========================
+# La estrategia que funcionó la última vez se prueba primero con timeout completo; el resto
+# se prueba con FALLBACK_TIMEOUT, así un candidato muerto cuesta ~1.5 s y no 9 s.
+_SEL_CACHE = {}
+FALLBACK_TIMEOUT = 1500
+
+async def resolve(page, name, strategies, timeout=9000):
+    # strategies: tupla de (clave, fn(page, timeout) -> awaitable con resultado o None/False)
+    cached = _SEL_CACHE.get(name)
+    ordered = sorted(strategies, key=lambda st: st[0] != cached)
+    for i, (key, fn) in enumerate(ordered):
+        res = await fn(page, timeout if i == 0 else FALLBACK_TIMEOUT)
+        if res:
+            _SEL_CACHE[name] = key
+            return res
+    return None
+
+_SUBJECT_STRATEGIES = (
+    ("css", lambda page, t: probe_locator(page, SUBJECT_CANDS, timeout=t)),
+    ("label", lambda page, t: first_locator(page, "label", "Subject", timeout=t)),
+)
+_NUMBER_STRATEGIES = (
+    ("css", lambda page, t: probe_locator(page, NUMBER_CANDS, timeout=t)),
+    ("label", lambda page, t: first_locator(page, "label", "Number", timeout=t)),
+)
+_SEARCH_STRATEGIES = (
+    ("probe", lambda page, t: probe_locator(page, SEARCH_CANDS, text_re=SEARCH_TEXT, timeout=t)),
+    ("role", lambda page, t: first_locator(page, "role", ("button", "Search Classes"), timeout=t)),
+    ("text", lambda page, t: first_locator(page, "text", "Search Classes", timeout=t)),
+)
+
+async def get_subject_input(page):
+    loc = await resolve(page, "subject", _SUBJECT_STRATEGIES)
+    if loc: return loc
     raise RuntimeError("No se encontró el campo 'Subject'.")
 
-def get_number_input(page):
-    for k, v in [
-        ("placeholder", "Number"),
-        ("label", "Number"),
-        ("label", "Course Number"),
-        ("css", 'input[aria-label*="Number" i]'),
-        ("css", '#number'),
-        ("css", 'input[name="number"]'),
-        ("css", 'input[name="catalogNbr"]'),
-        ("css", '#catalogNbr'),
-        ("css", 'input[id*="number" i]'),
-        ("css", 'input[id*="catalog" i]'),
-    ]:
-        loc = first_locator(page, k, v)
-        if loc: return loc
+async def get_number_input(page):
+    loc = await resolve(page, "number", _NUMBER_STRATEGIES)
+    if loc: return loc
     raise RuntimeError("No se encontró el campo 'Number'.")
 
-def set_term(page, term_label_text):
-    for k, v in [
-        ("css", 'select[name="term"]'),
-        ("css", "#term"),
-        ("css", 'select[aria-label*="Term" i]'),
-        ("label", "Term"),
-    ]:
-        loc = first_locator(page, k, v)
-        if loc:
+# label del term -> value del <option>; se llena leyendo el <select> una vez y se persiste en TERM_CODES_FILE
+TERM_CODES = {}
+_TERM_OPTIONS_JS = "(sel) => [...(sel.options || [])].map(o => [o.textContent.trim(), o.value])"
+
+async def _term_via_select(page, term_label_text, timeout):
+    loc = await probe_locator(page, TERM_CANDS, timeout=timeout) or \
+        await first_locator(page, "label", "Term", timeout=FALLBACK_TIMEOUT)
+    if not loc:
+        return False
+    try:
+        if term_label_text not in TERM_CODES:
+            TERM_CODES.update((label, value) for label, value in await loc.evaluate(_TERM_OPTIONS_JS) if label and value)
+        code = TERM_CODES.get(term_label_text)
+        if code:
             try:
-                loc.select_option(label=term_label_text)
-                return
+                await loc.select_option(value=code, timeout=FALLBACK_TIMEOUT)
+                return True
             except Exception:
-                break
-    combo = first_locator(page, "role", ("combobox", "Term"), name_regex=True)
-    if combo:
-        combo.click()
-        opt = first_locator(page, "role", ("option", term_label_text))
-        if opt: opt.click(); return
-        opt2 = first_locator(page, "text", term_label_text)
-        if opt2: opt2.click(); return
-    label = first_locator(page, "text", "Term")
-    if label:
-        try: label.click()
-        except Exception: pass
-        opt3 = first_locator(page, "text", term_label_text)
-        if opt3: opt3.click(); return
-    raise RuntimeError("No se pudo seleccionar el Term.")
-
-def click_search(page):
-    clicked = False
-    for k, v, regex in [
-        ("role", ("button", "Search Classes"), False),
-        ("role", ("button", r"Search\s*Classes"), True),
-        ("text", "Search Classes", False),
-        ("css", 'button:has-text("Search Classes")', False),
-    ]:
-        loc = first_locator(page, k, v, name_regex=regex)
-        if loc:
-            loc.click()
-            clicked = True
-            break
-    if not clicked:
+                # Código cacheado que ya no existe en el <select>: lo olvidamos y vamos por label
+                TERM_CODES.pop(term_label_text, None)
+        await loc.select_option(label=term_label_text)
+        return True
+    except Exception:
+        return False
+
+async def _term_via_combobox(page, term_label_text, timeout):
+    combo = await first_locator(page, "role", ("combobox", "Term"), timeout=timeout, name_regex=True)
+    if not combo:
+        return False
+    await combo.click()
+    opt = await first_locator(page, "role", ("option", term_label_text), timeout=timeout) or \
+        await first_locator(page, "text", term_label_text, timeout=FALLBACK_TIMEOUT)
+    if opt: await opt.click(); return True
+    return False
+
+async def _term_via_text(page, term_label_text, timeout):
+    label = await first_locator(page, "text", "Term", timeout=timeout)
+    if not label:
+        return False
+    try: await label.click()
+    except Exception: pass
+    opt = await first_locator(page, "text", term_label_text, timeout=timeout)
+    if opt: await opt.click(); return True
+    return False
+
+async def set_term(page, term_label_text):
+    ok = await resolve(page, "term", (
+        ("select", lambda page, t: _term_via_select(page, term_label_text, t)),
+        ("combobox", lambda page, t: _term_via_combobox(page, term_label_text, t)),
+        ("text", lambda page, t: _term_via_text(page, term_label_text, t)),
+    ))
+    if not ok:
+        raise RuntimeError("No se pudo seleccionar el Term.")
+
+async def click_search(page):
+    loc = await resolve(page, "search", _SEARCH_STRATEGIES)
+    if not loc:
         raise RuntimeError("No encontré el botón de búsqueda.")
-    page.keyboard.press("Enter")
-    page.wait_for_timeout(800)
+    await loc.click()
+    await page.keyboard.press("Enter")
+
+# Espera "Results for" y verifica los filtros en el mismo callback (un round-trip, no locator + inner_text)
+_FILTERS_APPLIED_JS = """([term, subj, num]) => {
+    const txt = document.body.innerText || '';
+    if (!txt.includes('Results for')) return null;
+    return {ok: txt.includes(term) && txt.includes(subj) && txt.includes(num)};
+}"""
 
-def ensure_filters_applied(page, term, subj, num):
+async def ensure_filters_applied(page, term, subj, num):
     try:
-        first_locator(page, "text", "Results for", timeout=15000)
-        txt = page.inner_text("body")
-        return (term in txt) and (subj in txt) and (num in txt)
+        handle = await page.wait_for_function(_FILTERS_APPLIED_JS, arg=[term, subj, num], timeout=15000)
+        return bool((await handle.json_value())["ok"])
+    except _pw().TimeoutError:
+        # Sin "Results for": igual que antes, miramos si los filtros aparecen en la página
+        try:
+            txt = await page.inner_text("body")
+            return (term in txt) and (subj in txt) and (num in txt)
+        except Exception:
+            return False
     except Exception:
         return False
 
 # =========================
 # Extracción de resultados
 # =========================
-def find_col(headers, needle):
-    needle = needle.lower()
-    for i, h in enumerate(headers):
-        if needle in h.lower():
-            return i
-    return None
+# Orden = orden de desempaquetado en extract_from_table_like
+HEADER_NEEDLES = ("course", "title", "number", "instructor", "days", "start", "end", "location", "open seats")
+_HEADER_INDEX_CACHE = {}   # tuple(headers) -> índices; mismas cabeceras en todas las queries
+
+def _col(lo, needle):
+    return next((i for i, h in enumerate(lo) if needle in h), None)
+
+def header_indices(headers):
+    key = tuple(headers)
+    idx = _HEADER_INDEX_CACHE.get(key)
+    if idx is None:
+        lo = [h.lower() for h in headers]
+        idx = _HEADER_INDEX_CACHE[key] = tuple(_col(lo, needle) for needle in HEADER_NEEDLES)
+    return idx
 
 def parse_open_seats(s: str):
     m = re.search(r'(\d+)\s*of\s*(\d+)', s or "", re.I)
@@ -200,51 +560,34 @@ def parse_open_seats(s: str):
     return None, None
 
 def should_exclude_location(location_text: str) -> bool:
-    if not location_text:
-        return False
-    try:
-        return re.search(LOCATION_EXCLUDE_REGEX, location_text, flags=re.I) is not None
-    except re.error:
-        return False
+    return bool(_LOCATION_EXCLUDE_RE and location_text and _LOCATION_EXCLUDE_RE.search(location_text))
 
-def extract_from_table_like(component, is_aria=False):
-    headers = [h.strip() for h in (
-        component.locator('[role="columnheader"]') if is_aria else component.locator('th')
-    ).all_inner_texts()]
-
-    idx_course = find_col(headers, "course")
-    idx_title  = find_col(headers, "title")
-    idx_num    = find_col(headers, "number")
-    idx_instr  = find_col(headers, "instructor")
-    idx_days   = find_col(headers, "days")
-    idx_start  = find_col(headers, "start")
-    idx_end    = find_col(headers, "end")
-    idx_loc    = find_col(headers, "location")
-    idx_open   = find_col(headers, "open seats")
+# Un solo round-trip CDP: cabeceras + celdas de todas las filas como string[][]
+_TABLE_DUMP_JS = """(el, [headSel, rowSel, cellSel]) => {
+    const txt = (n) => (n.innerText || '').trim();
+    const headers = [...el.querySelectorAll(headSel)].map(txt);
+    const rows = [...el.querySelectorAll(rowSel)]
+        .map(r => [...r.querySelectorAll(cellSel)].map(txt))
+        .filter(cells => cells.length > 0);
+    return {headers, rows};
+}"""
 
-    rows = []
-    row_sel = '[role="row"]' if is_aria else 'tbody tr'
-    cell_sel = '[role="gridcell"], [role="cell"]' if is_aria else 'td'
-    trs = component.locator(row_sel)
-    count = trs.count()
-    for i in range(count):
-        cells = trs.nth(i).locator(cell_sel)
-        if cells.count() == 0:
-            continue
-        texts = [cells.nth(j).inner_text().strip() for j in range(cells.count())]
+async def extract_from_table_like(component, is_aria=False):
+    if is_aria:
+        sels = ['[role="columnheader"]', '[role="row"]', '[role="gridcell"], [role="cell"]']
+    else:
+        sels = ['th', 'tbody tr', 'td']
+    data = await component.evaluate(_TABLE_DUMP_JS, sels)
+    idx_tuple = header_indices(data["headers"])
 
-        def get(idx):
-            return texts[idx].strip() if idx is not None and idx < len(texts) else ""
+    rows = []
+    for texts in data["rows"]:
+        n = len(texts)
 
-        course = get(idx_course)
-        title  = get(idx_title)
-        num    = get(idx_num)          # Class #
-        instr  = get(idx_instr)
-        days   = get(idx_days)
-        start  = get(idx_start)
-        endt   = get(idx_end)
-        loc    = get(idx_loc)
-        open_s = get(idx_open)
+        # num = Class #
+        course, title, num, instr, days, start, endt, loc, open_s = [
+            texts[k] if (k is not None and k < n) else "" for k in idx_tuple
+        ]
 
         if should_exclude_location(loc):
             continue
@@ -265,8 +608,8 @@ def extract_from_table_like(component, is_aria=False):
         })
     return rows
 
-def extract_textual(page, subj, num):
-    body_txt = page.inner_text("body")
+async def extract_textual(page, subj, num):
+    body_txt = await page.inner_text("body")
     lines = [l.strip() for l in body_txt.splitlines()]
     rows = []
 
@@ -324,148 +667,513 @@ def extract_textual(page, subj, num):
         i += 1
     return rows
 
-def wait_component_or_none(page):
-    for sel in ['[role="grid"]', '[role="table"]']:
-        try:
-            comp = page.locator(sel).first
-            comp.wait_for(state="visible", timeout=12000)
-            return ("aria", comp)
-        except Exception:
+def _first(d, *keys):
+    for k in keys:
+        v = d.get(k)
+        if v not in (None, ""):
+            return v
+    return None
+
+def _as_int(v):
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return None
+
+def rows_from_api(data):
+    # Mapea el JSON del XHR al mismo dict que produce el scraping del DOM.
+    # Devuelve None si el formato no se reconoce (=> fallback al DOM).
+    items = data.get("classes") if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        return None
+
+    rows = []
+    recognized = 0
+    for item in items:
+        if not isinstance(item, dict):
             continue
+        cls = item.get("CLAS") or item
+        seat = item.get("seatInfo") or {}
+        if not isinstance(cls, dict) or not isinstance(seat, dict):
+            return None   # el API cambió de forma => fallback (Playwright / DOM)
+        class_id = str(_first(cls, "CLASSNBR", "classNbr", "CLASS_NBR") or "").strip()
+        if not class_id:
+            continue
+        recognized += 1
+
+        loc = str(_first(cls, "LOCATION", "LOCATIONDESCR", "FACILITYDESCR", "CAMPUSDESCR") or "").strip()
+        if should_exclude_location(loc):
+            continue
+
+        # _first(seat, ...) puede ser un 0 legítimo: nivel clase solo si falta del todo
+        cap = _first(seat, "ENRL_CAP")
+        cap = _as_int(cap if cap is not None else _first(cls, "ENRLCAP", "ENRL_CAP"))
+        tot = _first(seat, "ENRL_TOT")
+        tot = _as_int(tot if tot is not None else _first(cls, "ENRLTOT", "ENRL_TOT")) or 0
+        open_now = max(cap - tot, 0) if cap is not None else 0
+
+        instr = _first(cls, "INSTRUCTORSLIST", "INSTRUCTOR") or ""
+        if isinstance(instr, list):
+            instr = ", ".join(str(x).strip() for x in instr if x)
+
+        rows.append({
+            "class_id": class_id,
+            "course": f'{str(_first(cls, "SUBJECT") or "").strip()} {str(_first(cls, "CATALOGNBR") or "").strip()}'.strip(),
+            "title": str(_first(cls, "TITLE", "COURSETITLELONG") or "").strip(),
+            "instructor": str(instr).strip(),
+            "days": str(_first(cls, "DAYLIST", "DAYS") or "").strip(),
+            "start": str(_first(cls, "STARTTIME", "START_TIME") or "").strip(),
+            "end": str(_first(cls, "ENDTIME", "END_TIME") or "").strip(),
+            "location": loc,
+            "open_text": f"{open_now} of {cap}" if cap is not None else "",
+            "open_now": open_now,
+            "open_total": cap,
+        })
+    if items and not recognized:
+        return None
+    return rows
+
+def normalize_rows(rows):
+    for r in rows:
+        # Numéricos normalizados una vez: el sort y format_line no necesitan .get() or 0
+        r["open_now"] = int(r.get("open_now") or 0)
+        r["open_total"] = _as_int(r.get("open_total"))
+        r["_sig"] = row_sig(r)
+    return rows
+
+# Un solo poll en el browser: grid/table ARIA visible, si no la <table> visible cuyas cabeceras
+# traen "Open Seats" (o la primera visible). Devuelve [tipo, selector, índice] o null mientras no haya nada.
+_COMPONENT_JS = """() => {
+    const visible = (el) => el.offsetParent !== null;
+    for (const sel of ['[role="grid"]', '[role="table"]']) {
+        const i = [...document.querySelectorAll(sel)].findIndex(visible);
+        if (i >= 0) return ['aria', sel, i];
+    }
+    const tables = [...document.querySelectorAll('table')].slice(0, 10);
+    let first = -1;
+    for (let i = 0; i < tables.length; i++) {
+        if (!visible(tables[i])) continue;
+        if (first < 0) first = i;
+        const heads = [...tables[i].querySelectorAll('th')].map(th => (th.innerText || '').toLowerCase());
+        if (heads.some(h => h.includes('open seats'))) return ['html', 'table', i];
+    }
+    return first >= 0 ? ['html', 'table', first] : null;
+}"""
+
+async def wait_component_or_none(page):
     try:
-        tbl = page.locator("table").first
-        tbl.wait_for(state="visible", timeout=8000)
-        return ("html", tbl)
-    except Exception:
+        handle = await page.wait_for_function(_COMPONENT_JS, timeout=12000)
+        typ, sel, idx = await handle.json_value()
+    except _pw().TimeoutError:
         return (None, None)
+    return (typ, page.locator(sel).nth(idx))
 
-def extract_rows(page, subj, num):
-    typ, comp = wait_component_or_none(page)
-    if typ == "aria":
-        return extract_from_table_like(comp, is_aria=True)
-    elif typ == "html":
-        return extract_from_table_like(comp, is_aria=False)
-    else:
-        return extract_textual(page, subj, num)
+async def extract_rows(page, subj, num, api_data=None):
+    rows = rows_from_api(api_data) if api_data is not None else None
+    if rows is None:
+        typ, comp = await wait_component_or_none(page)
+        if typ == "aria":
+            rows = await extract_from_table_like(comp, is_aria=True)
+        elif typ == "html":
+            rows = await extract_from_table_like(comp, is_aria=False)
+        else:
+            rows = await extract_textual(page, subj, num)
+    return normalize_rows(rows)
 
 # =========================
 # Flujo principal
 # =========================
-def reset_search(page):
-    btn = first_locator(page, "text", "Clear filters", timeout=2000)
-    if btn:
-        try: btn.click()
-        except Exception: pass
-    else:
-        page.goto(URL, wait_until="domcontentloaded", timeout=60000)
-    page.wait_for_timeout(500)
-
-def apply_filters_and_search(page, subj, num, term, tries=3):
-    for _ in range(tries):
-        wait_hydrated(page, term)
-        s_in = get_subject_input(page)
-        n_in = get_number_input(page)
+# Contenedor de resultados (o el encabezado "Results for" si no hay filas)
+RESULTS_READY_SEL = '[role="grid"], [role="table"], table, :text("Results for")'
+
+def _is_api_response(resp):
+    return API_URL_MATCH in resp.url and resp.request.resource_type in ("xhr", "fetch")
+
+async def _probe_meta(resp):
+    # Lo necesario para repetir el XHR con validadores HTTP (If-None-Match / If-Modified-Since).
+    # Si el endpoint no manda validadores, guardamos un fingerprint del body para comparar.
+    req = resp.request
+    if req.method != "GET":
+        return None
+    etag, last_mod = resp.headers.get("etag"), resp.headers.get("last-modified")
+    headers = await req.all_headers()
+    return {
+        "url": resp.url,
+        "headers": {k: v for k, v in headers.items() if k.lower() in PROBE_HEADER_ALLOW},
+        "etag": etag,
+        "last_modified": last_mod,
+        "body_hash": None if (etag or last_mod) else fingerprint(await resp.body()),
+    }
+
+# Un intento sobre una página recién cargada. Devuelve (ok, api); api es
+# {"data": JSON del XHR de búsqueda, "probe": validadores o None} si se pudo capturar
+async def apply_filters_and_search(page, subj, num, term):
+    await wait_hydrated(page, term)
+    s_in = await get_subject_input(page)
+    n_in = await get_number_input(page)
+    try:
+        await s_in.fill(""); await n_in.fill("")
+    except Exception:
+        pass
+    await s_in.fill(subj)
+    await n_in.fill(num)
+    await set_term(page, term)
+
+    resp = None
+    try:
+        async with page.expect_response(_is_api_response, timeout=15000) as resp_info:
+            await click_search(page)
+        resp = await resp_info.value
+    except _pw().TimeoutError:
+        pass
+    if resp is not None and resp.ok and subj in resp.url and num in resp.url:
         try:
-            s_in.fill(""); n_in.fill("")
-        except Exception:
-            pass
-        s_in.fill(subj)
-        n_in.fill(num)
-        set_term(page, term)
-        click_search(page)
-        page.wait_for_load_state("networkidle")
-        page.wait_for_timeout(1000)
-        if ensure_filters_applied(page, term, subj, num):
-            return True
-        reset_search(page)
-    return False
+            return True, {"data": await resp.json(), "probe": await _probe_meta(resp)}
+        except Exception as e:
+            print("WARN: XHR de búsqueda sin JSON válido; usando DOM ->", e)
+
+    # Esperamos a que se pinten resultados (networkidle nunca llega con los pings de analytics)
+    try:
+        await page.locator(RESULTS_READY_SEL).first.wait_for(state="visible", timeout=15000)
+    except Exception:
+        pass
+    return await ensure_filters_applied(page, term, subj, num), None
 
 def group_key(q):
     return f'{q["subject"]}{q["number"]}-{q["term"]}'
 
 def format_line(r, prev=None, triggered=False):
-    green = (r["open_now"] or 0) > 0
-    dot = "🟢" if green else "🔴"
+    open_now = r["open_now"]
+    dot = "🟢" if open_now > 0 else "🔴"
     if triggered:
         dot += " 🟠"  # solo si el cambio cumple trigger
 
-    # Δ visible solo si hay prev y cambió seats
+    seats = r.get("open_text") or (f'{open_now} of {r["open_total"]}' if r.get("open_total") else str(open_now))
+    head = " — ".join((
+        "Class #" + (r.get("class_id") or "").strip(),
+        " - ".join(((r.get("course") or "").strip(), (r.get("title") or "").strip())).strip(" -"),
+        "Open " + seats,
+    ))
+    tail = "".join(" — " + r[k].strip() for k in ("location", "start", "instructor") if r.get(k))
+    # Δ visible solo si hay prev y cambió seats (caso común: prev is None, nos lo saltamos)
     delta_txt = ""
     if prev is not None:
-        po = prev.get("open_now", 0) or 0
-        no = r.get("open_now", 0) or 0
-        d = no - po
+        d = open_now - (prev.get("open_now") or 0)
         if d != 0:
-            delta_txt = f' (Δ{("+" if d>0 else "")}{d})'
-
-    seats = r.get("open_text") or (f'{r["open_now"]} of {r["open_total"]}' if r.get("open_total") else f'{r["open_now"]}')
-    pieces = [
-        f'Class #{(r.get("class_id") or "").strip()}',
-        f'{(r.get("course") or "").strip()} - {(r.get("title") or "").strip()}'.strip(" -"),
-        f'Open {seats}{delta_txt}',
-    ]
-    if r.get("location"):
-        pieces.append(r["location"].strip())
-    if r.get("start"):
-        pieces.append(r["start"].strip())
-    if r.get("instructor"):
-        pieces.append(r["instructor"].strip())
-    return f'{dot} ' + " — ".join(pieces)
+            delta_txt = "".join((" (Δ", "+" if d > 0 else "", str(d), ")"))
+    return "".join((dot, " ", head, delta_txt, tail))
+
+# Máximo de queries scrapeando en paralelo (= tamaño del pool de BrowserContexts)
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "4"))
+
+# Chromium persistente entre corridas (browser_daemon.py) vía CDP. 1=habilitado / 0=launch en cada tick.
+BROWSER_DAEMON = int(os.getenv("BROWSER_DAEMON", "0"))
+# Pool de Chrome externo (p.ej. browserless, ver docker-compose.yml). Tiene prioridad sobre el daemon.
+CDP_URL = os.getenv("CDP_URL", "").strip()
+# Reciclar el daemon tras N contexts para no arrastrar fugas de memoria de Chromium
+BROWSER_RECYCLE_AFTER = int(os.getenv("BROWSER_RECYCLE_AFTER", "200"))
+
+# Recursos que la extracción no necesita (el SPA sí necesita script/xhr/fetch)
+BLOCK_RESOURCE_TYPES = frozenset({"image", "media", "font", "stylesheet", "websocket"})
+# Trackers: se abortan siempre, también con ALLOW_HOSTS vacío (match por sufijo de host, subdominios incluidos)
+BLOCK_HOSTS = ("google-analytics.com", "doubleclick.net", "segment.io")
+
+# Los assets propios del catálogo pasan siempre (su CSS decide qué controles son visibles)
+FIRST_PARTY_MATCH = "catalog"
+# Solo hosts bajo estos dominios (coma-separados); el resto (analytics, tag managers, CDNs de terceros)
+# se aborta sin DNS/TLS. Vacío => sin allowlist.
+ALLOW_HOSTS = tuple(h.strip().lower() for h in os.getenv("ALLOW_HOSTS", "asu.edu").split(",") if h.strip())
+
+@functools.lru_cache(maxsize=256)
+def _host_in(host, domains):
+    return any(host == d or host.endswith("." + d) for d in domains)
+
+def _url_blocked(url):
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ("http", "https"):
+        return False
+    host = (parts.hostname or "").lower()
+    return _host_in(host, BLOCK_HOSTS) or bool(ALLOW_HOSTS) and not _host_in(host, ALLOW_HOSTS)
+
+async def _route_filter(route):
+    req = route.request
+    if _url_blocked(req.url):
+        await route.abort()
+    elif req.resource_type in BLOCK_RESOURCE_TYPES and FIRST_PARTY_MATCH not in req.url:
+        await route.abort()
+    else:
+        await route.continue_()
+
+async def install_blocking(context):
+    await context.route("**/*", _route_filter)
+    if DEBUG:
+        context.on("request", lambda req: print("REQ:", req.resource_type, req.url))
+
+async def new_scrape_context(browser):
+    # Video solo para depurar: grabarlo en cada corrida cuesta CPU y disco
+    context = await browser.new_context(
+        viewport={"width": 1366, "height": 768},
+        service_workers="block",   # un SW podría servir requests sin pasar por las rutas
+        **({"record_video_dir": VIDEO_DIR} if DEBUG else {}),
+    )
+    await install_blocking(context)
+    return context
+
+def query_stagger(q):
+    return hashlib.blake2b(group_key(q).encode(), digest_size=1).digest()[0] / 255 * QUERY_STAGGER_MAX
+
+async def process_query(pool, q):
+    subj = q.get("subject","").strip()
+    num  = q.get("number","").strip()
+    term = q.get("term","").strip()
+    if not (subj and num and term):
+        print("WARN: query inválida:", q)
+        return [], None
+
+    if JITTER_ON and QUERY_STAGGER_MAX > 0 and len(QUERIES) > 1:
+        await asyncio.sleep(query_stagger(q))
+
+    # Pool de contexts: la cola limita la concurrencia y cada query usa su propia página
+    context = await pool.get()
+    page = None
+    try:
+        # Reintento = página nueva en el mismo context (conserva cookies/localStorage),
+        # más barato que "Clear filters" + rehidratar + rellenar
+        for _ in range(3):
+            page = await context.new_page()
+            await page.goto(URL, wait_until="domcontentloaded", timeout=60000)
+            ok, api = await apply_filters_and_search(page, subj, num, term)
+            if ok:
+                break
+            await page.close()
+            page = None
+        else:
+            raise RuntimeError(f"No se pudo aplicar filtros para {subj} {num} ({term})")
+
+        rows = await extract_rows(page, subj, num, api["data"] if api else None)
+    finally:
+        if page is not None:
+            await page.close()
+        pool.put_nowait(context)
+
+    qkey = group_key(q)
+    for r in rows:
+        r["_q"] = qkey
+    return rows, (api or {}).get("probe")
+
+async def connect_daemon(p):
+    ws = browser_daemon.read_endpoint()
+    if ws:
+        try:
+            return await p.chromium.connect_over_cdp(ws)
+        except Exception as e:
+            print("WARN: browser daemon no responde; relanzando ->", e)
+            browser_daemon.stop()
+
+    daemon_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "browser_daemon.py")
+    subprocess.Popen([sys.executable, daemon_py, "start"],
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    for _ in range(int(browser_daemon.START_TIMEOUT / 0.25)):
+        await asyncio.sleep(0.25)
+        ws = browser_daemon.read_endpoint()
+        if ws:
+            break
+    if ws:
+        try:
+            return await p.chromium.connect_over_cdp(ws)
+        except Exception as e:
+            print("WARN: no se pudo conectar al browser daemon ->", e)
+    return None
+
+async def connect_remote(p):
+    try:
+        return await p.chromium.connect_over_cdp(CDP_URL)
+    except Exception as e:
+        print("WARN: no se pudo conectar a CDP_URL; lanzando Chromium local ->", e)
+        return None
+
+async def scrape_all():
+    async with _pw().async_playwright() as p:
+        browser = None
+        if CDP_URL:
+            browser = await connect_remote(p)
+        elif BROWSER_DAEMON:
+            browser = await connect_daemon(p)
+        shared = browser is not None
+        if not shared:
+            browser = await p.chromium.launch(args=browser_daemon.CHROMIUM_ARGS)
+        contexts = []
+        try:
+            pool = asyncio.Queue()
+            for _ in range(max(1, min(len(QUERIES), MAX_CONCURRENCY))):
+                contexts.append(await new_scrape_context(browser))
+                pool.put_nowait(contexts[-1])
+            results = await asyncio.gather(
+                *[process_query(pool, q) for q in QUERIES],
+                return_exceptions=True,
+            )
+        finally:
+            # Con el daemon solo cerramos nuestros contexts, nunca el browser
+            for context in contexts:
+                await context.close()
+            if not shared:
+                await browser.close()
+
+    if shared and not CDP_URL:
+        if browser_daemon.bump_count(len(contexts)) >= BROWSER_RECYCLE_AFTER:
+            browser_daemon.stop()
+
+    # Si alguna query falló abortamos el tick entero (no pisamos el estado con datos parciales)
+    for res in results:
+        if isinstance(res, BaseException):
+            raise res
+    all_rows = [r for rows, _ in results for r in rows]
+    probes = {group_key(q): probe for q, (_, probe) in zip(QUERIES, results) if probe}
+    return all_rows, probes
+
+def _probe_request(probe):
+    # Devuelve (status, body, headers); body solo con 200
+    headers = dict(probe.get("headers") or {})
+    headers.update(API_HEADERS)
+    headers["Accept-Encoding"] = "gzip"
+    if probe.get("etag"):
+        headers["If-None-Match"] = probe["etag"]
+    if probe.get("last_modified"):
+        headers["If-Modified-Since"] = probe["last_modified"]
+    try:
+        with urllib.request.urlopen(urllib.request.Request(probe["url"], headers=headers), timeout=10) as resp:
+            body = resp.read()
+            if resp.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            return resp.status, body, resp.headers
+    except urllib.error.HTTPError as e:
+        return e.code, None, e.headers
+    except Exception as e:
+        print("WARN: XHR directo falló ->", e)
+        return None, None, None
+
+def template_probe(q):
+    # Arranque en frío (sin probe guardado): la URL del XHR sale de API_URL_TEMPLATE
+    if not API_URL_TEMPLATE:
+        return None
+    q = {**q, "term_code": q.get("term_code") or TERM_CODES.get((q.get("term") or "").strip())}
+    if "{term_code" in API_URL_TEMPLATE and not q["term_code"]:
+        return None   # sin código el API podría devolver otro term; mejor Chromium (que además arma TERM_CODES)
+    fields = {k: urllib.parse.quote(str(q.get(k) or "").strip()) for k in ("subject", "number", "term", "term_code")}
+    try:
+        url = API_URL_TEMPLATE.format(**fields)
+    except (KeyError, IndexError, ValueError) as e:
+        print("WARN: invalid API_URL_TEMPLATE ->", e)
+        return None
+    return {"url": url, "headers": {"accept": "application/json"}}
+
+def fetch_direct(old_state):
+    # Repite el XHR de búsqueda de cada query sin Chromium. 304 (o mismo fingerprint) => filas
+    # cacheadas; 200 con JSON reconocible => rows_from_api. Cualquier otra cosa => None (Playwright).
+    probes = old_state.get("probes") or {}
+    cached = defaultdict(list)
+    for r in old_state.get("rows") or []:
+        cached[r.get("_q")].append(r)
+
+    all_rows, new_probes = [], {}
+    for q in QUERIES:
+        if not all((q.get(f) or "").strip() for f in ("subject", "number", "term")):
+            continue
+        qkey = group_key(q)
+        probe = probes.get(qkey) if old_state.get("rows") else None
+        probe = probe or template_probe(q)
+        if not probe:
+            return None
+
+        status, body, headers = _probe_request(probe)
+        if status == 304 or (status == 200 and probe.get("body_hash") and fingerprint(body) == probe["body_hash"]):
+            rows = cached[qkey]
+            for r in rows:
+                r["_sig"] = row_sig(r)
+        elif status == 200 and DIRECT_API:
+            try:
+                rows = rows_from_api(_loads(body))
+            except ValueError:
+                rows = None
+            if rows is None:
+                return None
+            normalize_rows(rows)
+            for r in rows:
+                r["_q"] = qkey
+            etag, last_mod = headers.get("ETag"), headers.get("Last-Modified")
+            probe = {
+                "url": probe["url"],
+                "headers": probe.get("headers") or {},
+                "etag": etag,
+                "last_modified": last_mod,
+                "body_hash": None if (etag or last_mod) else fingerprint(body),
+            }
+        else:
+            return None
+        all_rows.extend(rows)
+        new_probes[qkey] = probe
+    return all_rows, new_probes
 
 def run():
     # Jitter opcional
-    if JITTER_MAX >= JITTER_MIN and JITTER_MAX > 0:
+    if JITTER_ON and JITTER_MAX >= JITTER_MIN and JITTER_MAX > 0:
         time.sleep(random.uniform(JITTER_MIN, JITTER_MAX))
 
     os.makedirs(DEBUG_DIR, exist_ok=True)
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch()
-        context = browser.new_context(viewport={"width": 1366, "height": 768})
-        page = context.new_page()
-        page.goto(URL, wait_until="domcontentloaded", timeout=60000)
-
-        all_rows = []
-        for q in QUERIES:
-            subj = q.get("subject","").strip()
-            num  = q.get("number","").strip()
-            term = q.get("term","").strip()
-            if not (subj and num and term):
-                print("WARN: query inválida:", q); continue
-
-            ok = apply_filters_and_search(page, subj, num, term, tries=3)
-            if not ok:
-                context.close(); browser.close()
-                raise RuntimeError(f"No se pudo aplicar filtros para {subj} {num} ({term})")
-
-            rows = extract_rows(page, subj, num)
-            for r in rows:
-                r["_q"] = group_key(q)
-            all_rows.extend(rows)
+    old_state = load_state(STATE, {"hash": None, "rows": []})
+    old_state["rows"] = state_rows(old_state)
 
-            page.wait_for_timeout(600)
-            reset_search(page)
+    term_codes = load_state(TERM_CODES_FILE, {})
+    term_codes_fresh = time.time() - term_codes.get("ts", 0) < TERM_CODES_MAX_AGE
+    if term_codes_fresh:
+        TERM_CODES.update(term_codes.get("codes") or {})
 
-        context.close()
-        browser.close()
+    direct = fetch_direct(old_state) if CONDITIONAL_PROBE else None
+    if direct is not None:
+        # Todas las queries resueltas vía XHR directo (304 o JSON): ni Chromium ni navegación
+        print("API: filas vía XHR directo; sin Chromium")
+        all_rows, probes = direct
+    else:
+        cached_sels = load_state(SELECTORS_FILE, {})
+        _SEL_CACHE.update(cached_sels)
+        all_rows, probes = asyncio.run(scrape_all())
+        if _SEL_CACHE != cached_sels:
+            save_state(_SEL_CACHE, SELECTORS_FILE)
+        if TERM_CODES and (not term_codes_fresh or TERM_CODES != term_codes.get("codes")):
+            save_state({"codes": TERM_CODES, "ts": int(time.time())}, TERM_CODES_FILE)
 
     # ===== Estado actual vs anterior
-    new_state = {"hash": hash_rows(all_rows), "rows": all_rows, "ts": int(time.time())}
-    try:
-        old_state = json.load(open(STATE, "r"))
-    except Exception:
-        old_state = {"hash": None, "rows": []}
 
     prev_by_id = {r.get("class_id"): r for r in old_state.get("rows", []) if r.get("class_id")}
-    curr_by_id = {r.get("class_id"): r for r in new_state["rows"] if r.get("class_id")}
+
+    new_sig_by_id = {r["class_id"]: r["_sig"] for r in all_rows if r.get("class_id")}
+    if "sig_by_id" in old_state:
+        old_sig_by_id = {k: tuple(v) for k, v in old_state["sig_by_id"].items()}
+    else:
+        old_sig_by_id = {k: row_sig(r) for k, r in prev_by_id.items()}
+
+    # Caso estable (mismas firmas que el tick anterior): arrastramos el hash previo sin re-hashear
+    same_rows = len(new_sig_by_id) == len(all_rows) == len(prev_by_id)
+    if old_state.get("hash") and same_rows and new_sig_by_id == old_sig_by_id:
+        state_hash = old_state["hash"]
+    else:
+        state_hash = hash_rows(all_rows)
+    new_state = {"hash": state_hash, "rows": all_rows, "sig_by_id": new_sig_by_id, "probes": probes, "ts": int(time.time())}
 
     # ==== TRIGGERS de notificación ====
     triggered_ids = set()
-    for k in (curr_by_id.keys() & prev_by_id.keys()):
-        prev = prev_by_id[k]
-        curr = curr_by_id[k]
-        po = prev.get("open_now", 0) or 0
-        no = curr.get("open_now", 0) or 0
+    # Mismo hash que el tick anterior => nada cambió, no hace falta calcular diffs
+    if new_state["hash"] == old_state.get("hash"):
+        changed = ()
+    else:
+        added, removed, changed = diff_sigs(old_sig_by_id, new_sig_by_id)
+        if DEBUG:
+            print("DIFF: added", sorted(added), "removed", sorted(removed),
+                  "changed", sorted(k for k, _, _ in changed))
+    for k, old_sig, new_sig in changed:
+        po = old_sig[0] or 0
+        no = new_sig[0] or 0
         if TRIGGER_ZERO_TO_POSITIVE and po == 0 and no > 0:
             triggered_ids.add(k)
         elif (po - no) >= TRIGGER_DROP_THRESHOLD:
@@ -474,25 +1182,25 @@ def run():
     any_change = len(triggered_ids) > 0
 
     # Agrupar para impresión
-    groups = {}
+    groups = defaultdict(list)
     for r in all_rows:
-        groups.setdefault(r["_q"], []).append(r)
+        groups[r["_q"]].append(r)
     for g in groups.values():
-        g.sort(key=lambda x: (x.get("open_now") or 0), reverse=True)
+        g.sort(key=itemgetter("open_now"), reverse=True)
 
     # ===== Pinging horario y guardado de estado
     now = int(time.time())
-    try:
-        notify_state = json.load(open(NOTIFY_STATE, "r"))
-    except Exception:
-        notify_state = {"last_nochange_ping": 0}
+    last_ping = old_state.get("last_nochange_ping")
+    if last_ping is None:
+        last_ping = load_state(LEGACY_NOTIFY_STATE, {}).get("last_nochange_ping", 0)
+    new_state["last_nochange_ping"] = last_ping
 
     if any_change:
         # Mensaje SOLO con líneas afectadas por triggers
         lines = ["🔔 **CHANGES**"]
-        for qkey in sorted(groups.keys()):
+        for qkey, grp in sorted(groups.items()):
             chunk = []
-            for r in groups[qkey]:
+            for r in grp:
                 if r.get("class_id") in triggered_ids:
                     prev = prev_by_id.get(r.get("class_id"))
                     chunk.append(format_line(r, prev=prev, triggered=True))
@@ -501,18 +1209,20 @@ def run():
                 lines.extend(chunk)
 
         notify("\n".join(lines))
-        with open(STATE, "w") as f: json.dump(new_state, f)
-        notify_state["last_nochange_ping"] = now   # reset del reloj horario
-        with open(NOTIFY_STATE, "w") as f: json.dump(notify_state, f)
-        print("CHANGED")
-    else:
+        new_state["last_nochange_ping"] = now   # reset del reloj horario
+    elif NOCHANGE_PING and (now - last_ping >= NOCHANGE_NOTIFY_INTERVAL):
         # Guardamos estado igual, pero el ping horario es MINIMAL
-        with open(STATE, "w") as f: json.dump(new_state, f)
-        if NOCHANGE_PING and (now - notify_state.get("last_nochange_ping", 0) >= NOCHANGE_NOTIFY_INTERVAL):
-            notify("⏰ Hourly update: no changes.")
-            notify_state["last_nochange_ping"] = now
-            with open(NOTIFY_STATE, "w") as f: json.dump(notify_state, f)
-        print("NOCHANGE")
+        notify("⏰ Hourly update: no changes.")
+        new_state["last_nochange_ping"] = now
+
+    for r in all_rows:
+        for k in _TRANSIENT_KEYS:   # _sig ya está persistido en sig_by_id
+            r.pop(k, None)
+    flush_notify()
+    save_state(pack_state(new_state, old_state), STATE)
+    if os.path.exists(LEGACY_NOTIFY_STATE):
+        os.remove(LEGACY_NOTIFY_STATE)
+    print("CHANGED" if any_change else "NOCHANGE")
 
 if __name__ == "__main__":
     try: